@@ -1,11 +1,11 @@
 import yfinance as yf
 import pandas as pd
-import numpy as np
 from datetime import date
 from datetime import timedelta
-from dotenv import load_dotenv
 import os
 import time
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 #import sys  
 #sys.path.insert(0, 'finance')
@@ -13,69 +13,182 @@ import time
 import ticker_dao
 #import rsi_calculations as rsi_calc
 
+#concurrent metadata lookups, small enough to stay polite to yahoo
+METADATA_WORKERS = 4
+
+#marks a last_date the caller did not pass, None is a real value (a ticker with no stored history)
+_UNSET = object()
+
 class StockActivity:
     def __init__(self, db_user, db_password, db_host, db_name):
         self.dao = ticker_dao.ticker_dao(db_user, db_password, db_host, db_name)
         self.dao.open_connection()
+        #yfinance handles and their info dicts, kept for the life of this object so each symbol is looked up once
+        self.tickers = {}
+        self.ticker_info = {}
 
-    def update_ticker_data(self,symbol):
-        ticker = yf.Ticker(symbol)
-        self.dao.updateStock(symbol, ticker.get('shortName'), ticker.get('industry'), ticker.get('sector'))
-    
-    def update_ticker_history(self, symbol, id):
-        ticker = yf.Ticker(symbol)
+    def get_ticker(self, symbol):
+        ticker = self.tickers.get(symbol)
 
-        df_last_date = self.dao.retrieve_last_activity_date(id)
-        start = date.today() - timedelta(weeks=520)  #create window with enough room for 50 day moving average
+        if ticker is None:
+            ticker = self.tickers.setdefault(symbol, yf.Ticker(symbol))
 
-        if df_last_date.iloc[0,0] != None:
-            start = df_last_date.iloc[0,0] + timedelta(days=1)
-        
-        end = date.today() + timedelta(days=1) 
-        try:
-            hist = ticker.history(interval="1d",start=start,end=end)
-            print(hist)
+        return ticker
+
+    def get_ticker_info(self, symbol):
+        #.info is a network call on every access, a failed lookup raises before anything is cached so it is retried next time
+        info = self.ticker_info.get(symbol)
+
+        if info is None:
+            info = self.get_ticker(symbol).info
+            self.ticker_info[symbol] = info
+
+        return info
+
+    def fetch_ticker_data(self, symbol):
+        #network only, so it can run on a worker thread while the caller owns the database connection
+        info = self.get_ticker_info(symbol)
+        return info.get('shortName'), info.get('industry'), info.get('sector')
+
+    def update_ticker_data(self, symbol, id):
+        name, industry, sector = self.fetch_ticker_data(symbol)
+        self.dao.update_stock_by_id(id, name, industry, sector)
+    
+    def history_start(self, last_date):
+        #resume the day after the newest stored day, otherwise create window with enough room for 50 day moving average
+        if pd.notnull(last_date):
+            return last_date + timedelta(days=1)
 
-            for i in range(len(hist)):    
-                idx = hist.index[i]
+        return date.today() - timedelta(weeks=520)
 
-                self.dao.update_trade_history(id, idx, hist.loc[idx,'Open'], hist.loc[idx,'Close'], hist.loc[idx,'Volume'], hist.loc[idx,'High'], hist.loc[idx,'Low'])
+    def download_history(self, symbols, start):
+        #a single request for every symbol that shares a start date, split per symbol afterwards
+        end = date.today() + timedelta(days=1)
+
+        try:
+            data = yf.download(symbols, start=start, end=end, interval="1d", group_by='ticker', auto_adjust=True, threads=True, progress=False)
         except Exception as e:
             print(e)
             time.sleep(120)
             print('Sleeping from failure')
+            return {}
+
+        histories = {}
+
+        if not data.empty:
+            for symbol in symbols:
+                if isinstance(data.columns, pd.MultiIndex):
+                    if symbol not in data.columns.get_level_values(0):
+                        continue
+                    hist = data[symbol]
+                else:
+                    hist = data
+
+                #the combined frame holds the union of every symbol's trading days, drop the ones this symbol has no prices for
+                hist = hist.dropna(subset=['Close'])
+
+                if not hist.empty:
+                    histories[symbol] = hist
+
+        #yf.download does not raise when yahoo fails or rate limits, it hands back empty frames instead
+        #a window of a few days can legitimately have no new trading days, a week or more cannot
+        if start <= date.today() - timedelta(days=7):
+            missing = [symbol for symbol in symbols if symbol not in histories]
+
+            if missing:
+                print(f'No history returned for {", ".join(missing)}')
+
+            if not histories:
+                time.sleep(120)
+                print('Sleeping from failure')
+        elif not histories:
+            print(f'No new history for {len(symbols)} symbols since {start}')
+
+        return histories
+
+    def update_ticker_history(self, symbol, id, last_date=_UNSET, hist=None):
+        #update_stock_activity passes the date it already has, a direct call has to look it up so stored days are not inserted again
+        if last_date is _UNSET:
+            last_date = self.dao.retrieve_last_activity_date(id)
+
+        start = self.history_start(last_date)
+
+        if not pd.notnull(last_date):
+            last_date = None
+
+        if hist is None:
+            end = date.today() + timedelta(days=1) 
+            #only the download is guarded, the DAO reports its own errors and a bad row should not trigger the back off
+            try:
+                hist = self.get_ticker(symbol).history(interval="1d",start=start,end=end)
+            except Exception as e:
+                print(e)
+                time.sleep(120)
+                print('Sleeping from failure')
+                return
+
+        #last_date is the newest day already stored (from the ticker list), so anything after it is new
+        #and there is no need to ask the database which days it has
+        if last_date is not None:
+            hist = hist[hist.index.date > last_date]
+
+        #whole columns are pulled out once and zipped, rather than two label lookups per cell
+        days = hist.index.strftime('%Y-%m-%d')
+        new_rows = list(zip(repeat(id), days, hist['Open'].to_numpy(), hist['Close'].to_numpy(), hist['Volume'].to_numpy(), hist['High'].to_numpy(), hist['Low'].to_numpy()))
+
+        self.dao.insert_trade_history_bulk(new_rows)
+        print(f'{symbol}: {len(new_rows)} new days')
         
-    def retrieve_ticker_history(self, id):    
-        return self.dao.retrieve_ticker_activity(ticker_id=id)
+    def retrieve_ticker_history(self, id, after_date=None):    
+        return self.dao.retrieve_ticker_activity(ticker_id=id, after_date=after_date)
 
     def update_stock_activity(self):
         df_ticker_list = self.dao.retrieve_ticker_list()
-        print(df_ticker_list)
-        count = 0
-
-        for i in range(len(df_ticker_list)):
-            stock_ticker = df_ticker_list.loc[i,0]
-            ticker_name = df_ticker_list.loc[i,1]
-            ticker_id = df_ticker_list.loc[i,2]
-            industry= df_ticker_list.loc[i,3]
-            sector = df_ticker_list.loc[i,4]
-
-            print(stock_ticker)
-            print(industry)
-            
-            if industry == None:
-                self.update_ticker_data(stock_ticker)
-            
-            self.update_ticker_history(stock_ticker,ticker_id)
-            count = count + 1
-            
-            if count == 3:
-                time.sleep(120)
-                print('Sleeping')
-                count = 0
+        print(f'Updating {len(df_ticker_list)} tickers')
+
+        #columns are positional (ticker, name, id, industry, sector, latest stored activity date)
+        tickers = list(df_ticker_list.itertuples(index=False))
+
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+            #metadata lookups run in the background while the history below is downloaded and stored
+            metadata = {executor.submit(self.fetch_ticker_data, stock_ticker): (stock_ticker, ticker_id)
+                        for stock_ticker, ticker_name, ticker_id, industry, sector, last_date in tickers if pd.isnull(industry)}
+
+            #tickers updated on the same day share a start date, so history comes down in one request per distinct start
+            #yf.download keeps module level state, so these stay sequential and use its own threads
+            symbols_by_start = {}
+            for stock_ticker, ticker_name, ticker_id, industry, sector, last_date in tickers:
+                symbols_by_start.setdefault(self.history_start(last_date), []).append(stock_ticker)
+
+            histories = {}
+            for start, symbols in symbols_by_start.items():
+                histories.update(self.download_history(symbols, start))
+
+            for stock_ticker, ticker_name, ticker_id, industry, sector, last_date in tickers:
+                hist = histories.get(stock_ticker)
+
+                #nothing new since the last run, or a failed download that download_history already reported
+                if hist is None:
+                    continue
+
+                self.update_ticker_history(stock_ticker,ticker_id,last_date,hist=hist)
+
+            #the connection is not thread safe, so the results are written from this thread as they arrive
+            for future in as_completed(metadata):
+                stock_ticker, ticker_id = metadata[future]
+
+                try:
+                    name, industry, sector = future.result()
+                except Exception as e:
+                    print(f'{stock_ticker}: {e}')
+                    continue
+
+                self.dao.update_stock_by_id(ticker_id, name, industry, sector)
         # rsi.calculateRSI(ticker_id)
        
 def main():
+    #only the command line entry point reads .env, importing StockActivity does not need dotenv
+    from dotenv import load_dotenv
     load_dotenv()
     
     stock_activity = StockActivity(os.getenv('DB_USER'), os.getenv('DB_PASS'), os.getenv('DB_HOST'), os.getenv('DB_NAME'))
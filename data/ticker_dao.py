@@ -1,8 +1,32 @@
-from datetime import date
+from contextlib import contextmanager
 import mysql.connector
-from mysql.connector import errorcode
 import pandas as pd
 
+#queries are built once at import and shared by every call (and keyed on by the prepared cursor cache)
+
+#each max() is answered from the (ticker_id, activity_date) index instead of grouping the whole activity table
+TICKER_LIST_QUERY = 'SELECT ticker, ticker_name, tick.id, industry, sector, (select max(activity_date) from investing.activity act where act.ticker_id = tick.id) as maxDate FROM investing.tickers tick order by maxDate;'
+
+INSERT_STOCK_QUERY = 'INSERT INTO tickers (ticker, ticker_name, trend, close) values (%s,%s,%s,%s)'
+UPDATE_STOCK_TREND_QUERY = 'UPDATE tickers SET trend = %s, close =%s WHERE ticker = %s'
+UPDATE_STOCK_QUERY = 'UPDATE tickers SET ticker_name = %s, industry =%s, sector=%s WHERE ticker = %s'
+
+#tickers.ticker is not indexed, the primary key is
+UPDATE_STOCK_BY_ID_QUERY = 'UPDATE tickers SET ticker_name = %s, industry =%s, sector=%s WHERE id = %s'
+
+#the existence check rides along with the insert so a day costs one round trip
+UPDATE_TRADE_HISTORY_QUERY = 'INSERT INTO investing.activity (ticker_id,activity_date,open,close,volume,updown, high, low) SELECT ?, ?, ?, ?, ?, ?, ?, ? FROM DUAL WHERE NOT EXISTS (SELECT 1 FROM investing.activity WHERE ticker_id = ? and activity_date = ?)'
+INSERT_TRADE_HISTORY_BULK_QUERY = 'INSERT INTO investing.activity (ticker_id,activity_date,open,close,volume,updown, high, low) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+
+TICKER_ACTIVITY_QUERY = "SELECT ticker_id, activity_date, open, close, volume, updown, high, low FROM investing.activity WHERE ticker_id = %s order by activity_date asc"
+TICKER_ACTIVITY_SINCE_QUERY = "SELECT ticker_id, activity_date, open, close, volume, updown, high, low FROM investing.activity WHERE ticker_id = %s and activity_date > %s order by activity_date asc"
+TICKER_ACTIVITY_BY_DAY_QUERY = "SELECT ticker_id, activity_date, open, close, volume, updown, high, low FROM investing.activity WHERE ticker_id = ? and activity_date = ? order by activity_date asc"
+LAST_ACTIVITY_DATE_QUERY = "SELECT max(activity_date) FROM investing.activity WHERE ticker_id = %s"
+LAST_RSI_QUERY = "SELECT activity_date, rsi FROM investing.rsi WHERE ticker_id = %s order by activity_date desc limit 10"
+
+#DECIMAL columns come back from the connector as decimal.Decimal objects, convert them once to float64
+PRICE_COLUMNS = ['open', 'close', 'high', 'low']
+
 class ticker_dao:
 
     def __init__(self, user, password, host, database):
@@ -12,27 +36,56 @@ class ticker_dao:
         self.db_name = database
 
         self.current_connection = None
+        self.prepared_cursors = {}
     
     def open_connection(self):
-        self.currenct_connection = mysql.connector.connect(user=self.db_user, 
+        self.current_connection = mysql.connector.connect(user=self.db_user, 
                       password=self.db_password,
                       host=self.db_host,
                       database=self.db_name)
+        self.prepared_cursors = {}
 
     def close_connection(self):
-       self.currenct_connection.close()
+       if self.current_connection is None:
+           return
 
-    def retrieve_ticker_list(self):
-        try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = 'SELECT ticker, ticker_name, tick.id, industry, sector FROM investing.tickers tick left join (select ticker_id, max(activity_date) as maxDate from investing.activity group by ticker_id) act on tick.id = act.ticker_id order by maxDate;'
+       for cursor in self.prepared_cursors.values():
+           cursor.close()
+       self.prepared_cursors = {}
+       self.current_connection.close()
+       self.current_connection = None
 
-            cursor.execute(query)
-            df_ticks = pd.DataFrame(cursor.fetchall())
-        
-            self.currenct_connection.commit()
+    @contextmanager
+    def open_cursor(self, commit=False):
+        #the cursor is closed even when a query fails, and a failed write is rolled back instead of left pending
+        cursor = self.current_connection.cursor()
+
+        try:
+            yield cursor
+
+            if commit:
+                self.current_connection.commit()
+        except mysql.connector.Error:
+            self.current_connection.rollback()
+            raise
+        finally:
             cursor.close()
+
+    def get_prepared_cursor(self, query):
+        #the server parses a prepared statement once, so keep one cursor per hot query for the life of the connection
+        cursor = self.prepared_cursors.get(query)
+
+        if cursor is None:
+            cursor = self.current_connection.cursor(prepared=True)
+            self.prepared_cursors[query] = cursor
+
+        return cursor
+
+    def retrieve_ticker_list(self):
+        try:
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(TICKER_LIST_QUERY)
+                df_ticks = pd.DataFrame(cursor.fetchall())
             
             return df_ticks
         except mysql.connector.Error as err:
@@ -40,37 +93,29 @@ class ticker_dao:
    
     def insert_stock(self, ticker, ticker_name):
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = 'INSERT INTO tickers (ticker, ticker_name, trend, close) values (%s,%s,%s,%s)'
-            cursor.execute(query, (ticker, ticker_name,'unknown', 0, False))
-
-            self.currenct_connection.commit()
-            cursor.close()
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(INSERT_STOCK_QUERY, (ticker, ticker_name,'unknown', 0, False))
         except mysql.connector.Error as err:
             print(err)
 
     def update_stock_trend(self,trend, close, ticker):
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = 'UPDATE tickers SET trend = %s, close =%s WHERE ticker = %s'
-            cursor.execute(query, (trend, float(close), ticker))
-
-            self.currenct_connection.commit()
-            cursor.close()
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(UPDATE_STOCK_TREND_QUERY, (trend, float(close), ticker))
         except mysql.connector.Error as err:
             print(err)
 
     def update_stock(self, symbol, name, industry, sector):
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = 'UPDATE tickers SET ticker_name = %s, industry =%s, sector=%s WHERE ticker = %s'
-            cursor.execute(query, (name, industry, sector, symbol))
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(UPDATE_STOCK_QUERY, (name, industry, sector, symbol))
+        except mysql.connector.Error as err:
+            print(err)
 
-            self.currenct_connection.commit()
-            cursor.close()
+    def update_stock_by_id(self, ticker_id, name, industry, sector):
+        try:
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(UPDATE_STOCK_BY_ID_QUERY, (name, industry, sector, int(ticker_id)))
         except mysql.connector.Error as err:
             print(err)
 
@@ -82,33 +127,51 @@ class ticker_dao:
                 rsi_state = 'down'
             elif(close > open):
                 rsi_state =  'up'
-            
-            #check to see if the record already exists
-            df = self.retrieve_ticker_activity_by_day(ticker_id, activity_date);
-            
-            if(df.empty):
-                cursor = self.currenct_connection.cursor(prepared=True)
-            
-                query = 'INSERT INTO investing.activity (ticker_id,activity_date,open,close,volume,updown, high, low) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
-                cursor.execute(query, (int(ticker_id), str(activity_date), float(open), float(close), float(volume), rsi_state,  float(high), float(low)))
-            
-                self.currenct_connection.commit()
-                cursor.close()
+
+            cursor = self.get_prepared_cursor(UPDATE_TRADE_HISTORY_QUERY)
+            day = activity_date.strftime('%Y-%m-%d')
+            cursor.execute(UPDATE_TRADE_HISTORY_QUERY, (int(ticker_id), day, float(open), float(close), float(volume), rsi_state,  float(high), float(low), int(ticker_id), day))
+        
+            self.current_connection.commit()
                 
         except mysql.connector.Error as err:
             print(err)
 
-    def retrieve_ticker_activity(self,ticker_id):
+    def insert_trade_history_bulk(self, rows):
+        #rows are (ticker_id, activity_date, open, close, volume, high, low) tuples for days not stored yet, dates as 'YYYY-MM-DD'
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = "SELECT ticker_id, activity_date, open, close, volume, updown, high, low FROM investing.activity  WHERE ticker_id = %s order by activity_date asc"
-            
-            cursor.execute(query,(int(ticker_id),))
-            df = pd.DataFrame(cursor.fetchall(), columns= ['ticker_id', 'activity_date', 'open', 'close', 'volume', 'updown' ,'high', 'low'])
-            df = df.set_index('activity_date')
+            values = []
+            for ticker_id, activity_date, open, close, volume, high, low in rows:
+                rsi_state = '' #going to leave it blank if there is no change in price
 
-            cursor.close()
+                if(open > close):
+                    rsi_state = 'down'
+                elif(close > open):
+                    rsi_state =  'up'
+
+                values.append((int(ticker_id), activity_date, float(open), float(close), float(volume), rsi_state,  float(high), float(low)))
+
+            if not values:
+                return
+
+            #a plain (non prepared) cursor lets executemany send all rows as a single multi-row INSERT
+            with self.open_cursor(commit=True) as cursor:
+                cursor.executemany(INSERT_TRADE_HISTORY_BULK_QUERY, values)
+                
+        except mysql.connector.Error as err:
+            print(err)
+
+    def retrieve_ticker_activity(self,ticker_id, after_date=None):
+        #pass the last date a caller already holds to only fetch the rows added since
+        try:
+            with self.open_cursor() as cursor:
+                if after_date is None:
+                    cursor.execute(TICKER_ACTIVITY_QUERY,(int(ticker_id),))
+                else:
+                    cursor.execute(TICKER_ACTIVITY_SINCE_QUERY,(int(ticker_id), after_date.strftime('%Y-%m-%d')))
+                df = pd.DataFrame(cursor.fetchall(), columns= ['ticker_id', 'activity_date', 'open', 'close', 'volume', 'updown' ,'high', 'low'])
+                df[PRICE_COLUMNS] = df[PRICE_COLUMNS].astype('float64')
+                df = df.set_index('activity_date')
             
             return df
         except mysql.connector.Error as err:
@@ -116,15 +179,12 @@ class ticker_dao:
             
     def retrieve_ticker_activity_by_day(self,ticker_id, activity_date):
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = "SELECT ticker_id, activity_date, open, close, volume, updown, high, low FROM investing.activity  WHERE ticker_id = %s and activity_date = %s order by activity_date asc"
+            cursor = self.get_prepared_cursor(TICKER_ACTIVITY_BY_DAY_QUERY)
             
-            cursor.execute(query,(int(ticker_id),  activity_date.strftime('%Y-%m-%d')))
+            cursor.execute(TICKER_ACTIVITY_BY_DAY_QUERY,(int(ticker_id),  activity_date.strftime('%Y-%m-%d')))
             df = pd.DataFrame(cursor.fetchall(), columns= ['ticker_id', 'activity_date', 'open', 'close', 'volume', 'updown' ,'high', 'low'])
+            df[PRICE_COLUMNS] = df[PRICE_COLUMNS].astype('float64')
             df = df.set_index('activity_date')
-
-            cursor.close()
             
             return df
         except mysql.connector.Error as err:
@@ -132,30 +192,21 @@ class ticker_dao:
 
     def retrieve_last_activity_date(self,ticker_id):
         try:
-            cursor = self.currenct_connection.cursor()
+            with self.open_cursor(commit=True) as cursor:
+                cursor.execute(LAST_ACTIVITY_DATE_QUERY,(int(ticker_id),))
+                #max() always returns exactly one row, None when the ticker has no activity yet
+                last_date = cursor.fetchone()[0]
             
-            query = "SELECT max(activity_date) FROM investing.activity  WHERE ticker_id = %s order by activity_date desc limit 1"
-            
-            cursor.execute(query,(int(ticker_id),))
-            df_last = pd.DataFrame(cursor.fetchall())
-        
-            self.currenct_connection.commit()
-            cursor.close()
-            
-            return df_last
+            return last_date
         except mysql.connector.Error as err:
             print(err)
 
     def retrieve_last_rsi(self,ticker_id):
         try:
-            cursor = self.currenct_connection.cursor()
-            
-            query = "SELECT activity_date, rsi FROM investing.rsi  WHERE ticker_id = %s order by activity_date desc limit 10"
-            
-            cursor.execute(query,(int(ticker_id),))
-            df_last = pd.DataFrame(cursor.fetchall(), columns=['activity_date','rsi'])
-        
-            cursor.close()
+            with self.open_cursor() as cursor:
+                cursor.execute(LAST_RSI_QUERY,(int(ticker_id),))
+                df_last = pd.DataFrame(cursor.fetchall(), columns=['activity_date','rsi'])
+                df_last['rsi'] = df_last['rsi'].astype('float64')
             
             return df_last
         except mysql.connector.Error as err:
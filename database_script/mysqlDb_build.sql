@@ -57,3 +57,9 @@ VALUES ('20230310232623_InitialCreate', '6.0.10');
 
 COMMIT;
 
+START TRANSACTION;
+
+CREATE INDEX `IX_activity_ticker_id_activity_date` ON `activity` (`ticker_id`, `activity_date`);
+
+COMMIT;
+
@@ -2,15 +2,43 @@ import numpy as np
 import pandas as pd
 import random
 import pickle
+import os
 from sklearn.preprocessing import StandardScaler
 from collections import defaultdict
 import gym
 from gym import spaces
 
+try:
+    from numba import njit
+except ImportError:
+    #numba is optional, without it the step kernel just runs as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+#When adding new data points, make sure to update this list
+FEATURE_COLUMNS = [ 'open','close', 'volume', 'updown', 'high', 'low','macd', 'Signal', 'rsi']
+
+#standardized features are clipped to +/- this many standard deviations before quantizing to uint8
+QUANTIZE_CLIP = 4.0
+
 class StockTradingEnvironment(gym.Env):
-    def __init__(self, data, max_holding_period=30):
+    def __init__(self, data, max_holding_period=30, quantize=False):
         super(StockTradingEnvironment, self).__init__()
         self.data = data
+        #pull the (already normalized) features out of pandas once so stepping never touches the DataFrame
+        #states stay float64, the q-table is keyed on the exact feature values so a narrower dtype would orphan saved tables
+        features = data[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+        if quantize:
+            features = quantize_features(features)
+        self.features = np.ascontiguousarray(features)
+        #the q-table is keyed by hashable states, so build every state once instead of converting a row per step
+        self.states = list(map(tuple, self.features))
+        self.closes = data['close'].to_numpy(dtype=np.float64)
+        #every episode walks the whole data set, so its length is known up front
+        self.last_step = len(self.closes) - 1
+        self.episode_length = max(self.last_step, 1)
         self.max_holding_period = max_holding_period
         self.current_step = 0
         self.current_holding_period = 0
@@ -18,7 +46,10 @@ class StockTradingEnvironment(gym.Env):
 
         self.action_space = spaces.Discrete(3)  # Buy, Sell, Hold
         #When adding new data points, make sure to update the shape of the observation space
-        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(9,), dtype=np.float32)
+        if quantize:
+            self.observation_space = spaces.Box(low=0, high=255, shape=(len(FEATURE_COLUMNS),), dtype=np.uint8)
+        else:
+            self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(len(FEATURE_COLUMNS),), dtype=np.float32)
 
     def reset(self):
         self.current_step = 0
@@ -27,41 +58,43 @@ class StockTradingEnvironment(gym.Env):
         return self.get_state()
 
     def get_state(self):
-        #when adding new data points, make sure to update the state
-        return self.data.iloc[self.current_step][[ 'open','close', 'volume', 'updown', 'high', 'low','macd', 'Signal', 'rsi']].values
+        return self.states[self.current_step]
 
     def step(self, action):
-        self.current_step += 1
-        self.current_holding_period += 1
+        self.current_step, self.current_holding_period, self.in_position, reward, done = step_kernel(
+            self.closes, self.last_step, self.current_step, action, self.in_position, self.current_holding_period)
 
-        if self.current_step >= len(self.data) - 1:
-            done = True
-        else:
-            done = False
+        next_state = self.get_state()
 
-        if self.in_position and not done:
-            reward = self.data.iloc[self.current_step + 1]['close'] - self.data.iloc[self.current_step]['close']
-        else:
-            reward = 0
+        return next_state, reward, done, {}
 
-        if action == 0:  # Buy
-            if not self.in_position:
-                self.in_position = True
-                self.current_holding_period = 0
-        elif action == 1:  # Sell
-            if self.in_position:
-                self.in_position = False
-                self.current_holding_period = 0
-        else:  # Hold
-            pass
+@njit(cache=True)
+def step_kernel(closes, last_step, current_step, action, in_position, current_holding_period):
+    current_step += 1
+    current_holding_period += 1
 
-       # if self.in_position and self.current_holding_period >= self.max_holding_period:
-       #     self.in_position = False
-       #     self.current_holding_period = 0
+    done = current_step >= last_step
 
-        next_state = self.get_state()
+    #branchless form of: reward only while holding and there is a next close
+    current = min(current_step, last_step)
+    reward = (closes[min(current + 1, last_step)] - closes[current]) * (in_position & (not done))
 
-        return next_state, reward, done, {}
+    #a buy (0) while flat or a sell (1) while holding flips the position and restarts the holding period,
+    #anything else (including hold) leaves both untouched
+    flipped = ((action == 0) & (not in_position)) | ((action == 1) & in_position)
+    in_position = in_position != flipped
+    current_holding_period = current_holding_period * (not flipped)
+
+   # if in_position and current_holding_period >= max_holding_period:
+   #     in_position = False
+   #     current_holding_period = 0
+
+    return current_step, current_holding_period, in_position, reward, done
+
+def quantize_features(features):
+    #the range is fixed rather than taken from the data so train and test environments bin identically
+    scaled = (np.clip(features, -QUANTIZE_CLIP, QUANTIZE_CLIP) + QUANTIZE_CLIP) * (255.0 / (2 * QUANTIZE_CLIP))
+    return np.rint(scaled).astype(np.uint8)
 
 def preprocess_data(data):
     data = data.copy()
@@ -73,7 +106,7 @@ def preprocess_data(data):
     
     data.dropna(inplace=True) 
     scaler = StandardScaler()
-    data[[ 'open','close', 'volume', 'updown', 'high', 'low','macd', 'Signal', 'rsi']] = scaler.fit_transform(data[[ 'open','close', 'volume', 'updown', 'high', 'low','macd', 'Signal', 'rsi']])
+    data[FEATURE_COLUMNS] = scaler.fit_transform(data[FEATURE_COLUMNS])
     
     return data, scaler
 
@@ -86,14 +119,13 @@ def q_learning(env, num_episodes=1500, alpha=0.1, gamma=0.99, epsilon_start=1.0,
 
         epsilon = epsilon_start * (epsilon_decay ** episode)
 
-        done = False
-        while not done:
+        for _ in range(env.episode_length):
             if random.uniform(0, 1) < epsilon:
                 action = env.action_space.sample()
             else:
                 action = np.argmax(q_table[state])
 
-            next_state, reward, done, _ = env.step(action)
+            next_state, reward, _, _ = env.step(action)
             next_state = tuple(next_state)
 
             best_next_action = np.argmax(q_table[next_state])
@@ -110,15 +142,11 @@ def q_learning(env, num_episodes=1500, alpha=0.1, gamma=0.99, epsilon_start=1.0,
 def test_q_learning(q_table, env):
     state = env.reset()
     state = tuple(state)
-    done = False
-    total_reward = 0
 
-    while not done:
+    for _ in range(env.episode_length):
         action = np.argmax(q_table[state])
-        next_state, reward, done, _ = env.step(action)
-        next_state = tuple(next_state)
-        state = next_state
-        total_reward += reward
+        next_state, _, _, _ = env.step(action)
+        state = tuple(next_state)
     
     # Add the logic for returning a buy, sell, or hold recommendation
     if action == 0:
@@ -129,26 +157,30 @@ def test_q_learning(q_table, env):
         return "Hold"
     
 def inverse_transform_close_price(scaler, value):
-    dummy_data = np.zeros((1, scaler.scale_.shape[0]))
-    dummy_data[0, 1] = value  # 'close' is the second column in the standardized data
-    return scaler.inverse_transform(dummy_data)[0, 1]
+    #works on a single value or a whole array of standardized closes
+    close_idx = FEATURE_COLUMNS.index('close')
+    return value * scaler.scale_[close_idx] + scaler.mean_[close_idx]
 
-def test_harness(historical_data, q_table, scaler, starting_capital=1000):
-    env = StockTradingEnvironment(historical_data)
+def test_harness(historical_data, q_table, scaler, starting_capital=1000, quantize=False):
+    #the states have to be built the same way the q-table was trained on
+    env = StockTradingEnvironment(historical_data, quantize=quantize)
     state = env.reset()
     state = tuple(state)
 
+    #un-scale every close once up front instead of on each trade
+    close_prices = inverse_transform_close_price(scaler, env.closes)
+
     capital = starting_capital
     num_shares = 0
     actions_log = []
 
-    for _ in range(len(historical_data) - 1):
+    for _ in range(env.last_step):
         action = np.argmax(q_table[state])
         actions_log.append((env.current_step, action))
 
         if action == 0:  # Buy
             if not env.in_position:
-                close_price = inverse_transform_close_price(scaler, env.data.iloc[env.current_step]['close'])
+                close_price = close_prices[env.current_step]
                 num_shares_to_buy = capital // close_price
                 if num_shares_to_buy > 0:
                     num_shares += num_shares_to_buy
@@ -157,7 +189,7 @@ def test_harness(historical_data, q_table, scaler, starting_capital=1000):
                     env.current_holding_period = 0
         elif action == 1:  # Sell
             if env.in_position:
-                close_price = inverse_transform_close_price(scaler, env.data.iloc[env.current_step]['close'])
+                close_price = close_prices[env.current_step]
                 capital += num_shares * close_price
                 num_shares = 0
                 env.in_position = False
@@ -171,7 +203,7 @@ def test_harness(historical_data, q_table, scaler, starting_capital=1000):
 
     # Sell any remaining shares at the end of the simulation
     if env.in_position:
-        close_price = inverse_transform_close_price(scaler, env.data.iloc[env.current_step]['close'])
+        close_price = close_prices[env.current_step]
         capital += num_shares * close_price
         num_shares = 0
 
@@ -180,18 +212,47 @@ def test_harness(historical_data, q_table, scaler, starting_capital=1000):
 
 def save_q_table(q_table, file_name):
     q_table_dict = dict(q_table)
-    with open(file_name, 'wb') as f:
-        pickle.dump(q_table_dict, f)
+    #write next to the target and swap it in, so an interrupted save never leaves a truncated table behind
+    tmp_file = file_name + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        #protocol 5 writes the numpy action-value arrays as raw buffers instead of re-encoding them
+        pickle.dump(q_table_dict, f, protocol=5)
+    os.replace(tmp_file, file_name)
 
 def load_q_table(file_name):
     with open(file_name, 'rb') as f:
         q_table_dict = pickle.load(f)
-    q_table = defaultdict(lambda: np.zeros(len(q_table_dict[list(q_table_dict.keys())[0]])), q_table_dict)
+    #every row has the same width, so size the default row once instead of copying all the keys on each unseen state
+    #an empty table (nothing trained yet) falls back to the environment's buy/sell/hold actions
+    first_row = next(iter(q_table_dict.values()), None)
+    n_actions = 3 if first_row is None else len(first_row)
+    q_table = defaultdict(lambda: np.zeros(n_actions), q_table_dict)
     return q_table
 
+def load_activity_data(csv_file):
+    #keep a parsed copy next to the csv and only re-parse when the csv is newer than it
+    cache_file = csv_file + '.pkl'
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(csv_file):
+        try:
+            return pd.read_pickle(cache_file)
+        except Exception as e:
+            #an unreadable cache is rebuilt from the csv below
+            print(e)
+
+    data = pd.read_csv(csv_file)
+    #write next to the cache and swap it in, an interrupted run must not leave a truncated cache that looks fresh
+    tmp_file = cache_file + '.tmp'
+    try:
+        data.to_pickle(tmp_file)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        #the cache is only a speed up, a directory that cannot be written to still gets the parsed csv
+        print(e)
+    return data
+
 def main():
     # Load dataset
-    data = pd.read_csv('celanse_activity.csv')  # Replace with your S&P 500 stock data file
+    data = load_activity_data('celanse_activity.csv')  # Replace with your S&P 500 stock data file
 
     # Preprocess data
     data, scaler = preprocess_data(data)